@@ -1,46 +1,247 @@
-import json
+import atexit
 import hmac
 import hashlib
-import queue
-import requests
+import logging
+import orjson
+import heapq
+import httpx
 import os
 import time
-from typing import Dict, Any
-from threading import Thread
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Dict, Any, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Lock, Condition
+from cachetools import TTLCache
 from flask import Flask, request, Response as Flask_Response, send_from_directory
 
 app = Flask(__name__)  # Flask app
-run_ids_queue = queue.SimpleQueue()  # Queue to store the run ids that need to be applied
+pending_runs = []  # Min-heap of (ready_at, run_id, attempt) for the runs that need to be applied
+pending_runs_cv = Condition()
+runs_in_flight = set()  # Run ids that are queued or being checked, guarded by pending_runs_cv
 processing_thread = None
+request_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="runtask")  # Workers for inbound run task calls
+atexit.register(request_pool.shutdown, wait=True)
+lookup_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="runtask-lookup")  # Workers for parallel TFC lookups
+atexit.register(lookup_pool.shutdown, wait=True)
 debug_statements = False
 
+# Logging is cheap to skip when a level is disabled, unlike print which takes the
+# stdout lock on every call from the polling loop.
+logger = logging.getLogger("runtask")
+logger.setLevel(logging.DEBUG if debug_statements else logging.INFO)
+if not logger.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(threadName)s %(message)s"))
+    logger.addHandler(_log_handler)
+
+_ws_cache = TTLCache(maxsize=4096, ttl=300)  # workspace id -> auto-apply setting
+_run_ws_cache = TTLCache(maxsize=8192, ttl=600)  # run id -> workspace id
+_ws_lock = Lock()
+
 
 # This code will handle the case when a secrets file was mounted at /etc/secrets/.env as well as the case when 
 # environment variables were used.
+@lru_cache(maxsize=1)
+def _load_secret_file() -> Optional[Dict[str, str]]:
+    # Read and parse the secrets file once, no matter how many secrets are looked up.
+    try:
+        with open('/etc/secrets/.env') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    logger.info("Found secrets file.")
+    lines = (line.strip() for line in data.splitlines())
+    return dict(line.split('=', 1) for line in lines if line and not line.startswith('#'))
+
+
 def get_secret(secret_name):
-    secrets_file = '/etc/secrets/.env'
-    if os.path.exists(secrets_file):
-        print("Found secrets file.")
-        with open(secrets_file) as f:
-            secrets = dict(line.strip().split('=', 1) for line in f if line.strip() and not line.startswith('#'))
-        return secrets.get(secret_name)
+    secrets = _load_secret_file()
+    if secrets is not None and secret_name in secrets:
+        return secrets[secret_name]
     return os.environ.get(secret_name)
 
 
 # Pull the HMAC secret and TFC API Token from the environment. These could also be
 # retrieved from Vault.
-secret_key = bytes(get_secret("HMAC_SECRET"), "utf-8")
+hmac_secret = get_secret("HMAC_SECRET")
+if not hmac_secret:
+    # Fail fast at startup rather than rejecting every request with an invalid HMAC.
+    raise RuntimeError("HMAC_SECRET is not set.")
+secret_key = hmac_secret.encode("utf-8")
+# TFC signs run task requests with HMAC-SHA512. BLAKE2b is only usable when the caller
+# has been set up to sign with keyed BLAKE2b-256 in the same header.
+hmac_algo = (get_secret("HMAC_ALGO") or "sha512").lower()
+if hmac_algo not in {"sha512", "blake2b"}:
+    raise RuntimeError(f"HMAC_ALGO must be 'sha512' or 'blake2b', got '{hmac_algo}'.")
+if hmac_algo == "blake2b" and len(secret_key) > hashlib.blake2b.MAX_KEY_SIZE:
+    raise RuntimeError(f"HMAC_SECRET must be at most {hashlib.blake2b.MAX_KEY_SIZE} bytes to use blake2b.")
 api_token = get_secret("TFC_API_TOKEN")
 
 # Headers required to call TFC
-tfc_headers = {
+tfc_headers = MappingProxyType({
     "Authorization": f"Bearer {api_token}",
     "Content-Type": "application/vnd.api+json"
-}
+})
+
+
+# Task result bodies sent back to TFC. Only the message changes between callbacks, so it
+# is the only part that gets serialized per request.
+_task_result_passed_tpl = b'{"data":{"type":"task-results","attributes":{"status":"passed","message":%s}}}'
+_task_result_failed_tpl = b'{"data":{"type":"task-results","attributes":{"status":"failed","message":%s}}}'
+
+# Bound every call to TFC so a hung connection can't tie up a worker or the polling
+# thread. The apply endpoint can briefly queue, so it gets a longer read timeout.
+tfc_timeout = httpx.Timeout(10.0, connect=3.05)
+apply_timeout = httpx.Timeout(30.0, connect=3.05)
+
+# Shared HTTP/2 client so calls to TFC are multiplexed over pooled keep-alive connections
+# instead of doing a new TCP and TLS handshake on every request.
+http = httpx.Client(headers=tfc_headers,
+                    timeout=tfc_timeout,
+                    transport=httpx.HTTPTransport(http2=True,
+                                                  retries=3,
+                                                  limits=httpx.Limits(max_connections=32,
+                                                                      max_keepalive_connections=32)))
+atexit.register(http.close)
+
+
+def get_workspace_auto_apply(workspace_id: str) -> Tuple[Optional[bool], Optional[str]]:
+    # The auto-apply setting rarely changes, so cache it rather than looking up the
+    # workspace on every callback. Returns the setting, or None and the error text.
+    with _ws_lock:
+        auto_apply = _ws_cache.get(workspace_id)
+    if auto_apply is not None:
+        return auto_apply, None
+
+    workspace_url = f"https://app.terraform.io/api/v2/workspaces/{workspace_id}"
+    try:
+        workspace_response = http.get(workspace_url, timeout=tfc_timeout)
+    except httpx.HTTPError as e:
+        return None, str(e)
+    if workspace_response.status_code != 200:
+        return None, workspace_response.text
+
+    auto_apply = orjson.loads(workspace_response.content)["data"]["attributes"]["auto-apply"]
+    with _ws_lock:
+        _ws_cache[workspace_id] = auto_apply
+    return auto_apply, None
+
+
+def enqueue_run(run_id: str, attempt: int = 0) -> None:
+    # Runs are ordered by the time they're ready to be checked, so a run that is
+    # waiting to be retried never holds up a run that is ready now. The first check
+    # happens right away and each retry backs off 2, 4, 8 and then 15 seconds.
+    delay = min(2 ** attempt, 15) if attempt else 0
+    with pending_runs_cv:
+        # TFC retries run task calls, so skip runs that are already being handled.
+        if attempt == 0:
+            if run_id in runs_in_flight:
+                return
+            runs_in_flight.add(run_id)
+        heapq.heappush(pending_runs, (time.monotonic() + delay, run_id, attempt))
+        pending_runs_cv.notify()
+
+
+def finish_run(run_id: str) -> None:
+    # The run won't be checked again, so allow it to be queued by a later call.
+    with pending_runs_cv:
+        runs_in_flight.discard(run_id)
+
+
+def get_run_states(run_ids: List[str]) -> Dict[str, Tuple[str, bool]]:
+    # Look up the status and whether the run is confirmable for a batch of runs. When two
+    # or more runs share a workspace they're fetched together with a single call to the
+    # workspace's runs list. Anything else, or anything not found that way, falls back
+    # to fetching the run on its own.
+    run_states = {}
+    runs_by_workspace = {}
+    with _ws_lock:
+        for run_id in run_ids:
+            workspace_id = _run_ws_cache.get(run_id)
+            if workspace_id is not None:
+                runs_by_workspace.setdefault(workspace_id, set()).add(run_id)
+
+    for workspace_id, workspace_run_ids in runs_by_workspace.items():
+        # A single run is cheaper to fetch directly than a page of the workspace's runs.
+        if len(workspace_run_ids) < 2:
+            continue
+        runs_url = f"https://app.terraform.io/api/v2/workspaces/{workspace_id}/runs?page[size]=20"
+        runs_response = http.get(runs_url, timeout=tfc_timeout)
+        if runs_response.status_code != 200:
+            logger.warning("Failed to list runs for %s - %s", workspace_id, runs_response.text)
+            continue
+        for run in orjson.loads(runs_response.content)["data"]:
+            if run["id"] in workspace_run_ids:
+                attributes = run["attributes"]
+                run_states[run["id"]] = (attributes["status"], attributes["actions"]["is-confirmable"])
+
+    for run_id in run_ids:
+        if run_id in run_states:
+            continue
+        run_details_url = f"https://app.terraform.io/api/v2/runs/{run_id}"
+        run_response = http.get(run_details_url, timeout=tfc_timeout)
+        if run_response.status_code != 200:
+            logger.warning("Failed to get run details for %s - %s", run_id, run_response.text)
+            continue
+        attributes = orjson.loads(run_response.content)["data"]["attributes"]
+        run_states[run_id] = (attributes["status"], attributes["actions"]["is-confirmable"])
+
+    return run_states
+
+
+# Run states that will never become confirmable. Runs in these states are dropped
+# instead of being polled until they time out of the queue.
+finished_run_statuses = {"applied", "discarded", "errored", "canceled", "force_canceled"}
+
+
+def apply_run(run_id: str, run_state: Optional[Tuple[str, bool]], attempt: int, apply_body: bytes) -> None:
+    if run_state is None:
+        # We errored here for some reason, remove this run id
+        logger.info("Removing %s from the processing queue.", run_id)
+        finish_run(run_id)
+        return
+    status, is_confirmable = run_state
+
+    # Check the status of the run id to ensure it hasn't already planned and finished.
+    # This could happen if the plan produced no chances and an apply was not required.
+    if status == "planned_and_finished":
+        logger.info("%s was planned and finished successfully. Removing from processing queue.", run_id)
+        finish_run(run_id)
+        return
+
+    # Someone else already applied, discarded or canceled the run, or it errored.
+    if status in finished_run_statuses:
+        logger.info("%s finished with status %s. Removing from processing queue.", run_id, status)
+        finish_run(run_id)
+        return
+
+    # Before trying to apply the run, check to see if it's confirmable.
+    if is_confirmable == False:
+        logger.debug("Still waiting for %s to ask for plan confirmation.", run_id)
+        enqueue_run(run_id, attempt + 1)
+        return
+
+    # We're in a good state and the run should be able to be applied.
+    apply_url = f"https://app.terraform.io/api/v2/runs/{run_id}/actions/apply"
+    try:
+        apply_response = http.post(apply_url, content=apply_body, timeout=apply_timeout)
+    except httpx.HTTPError as e:
+        logger.warning("Failed to apply run %s - %s", run_id, e)
+        enqueue_run(run_id, attempt + 1)
+        return
+    if apply_response.status_code == 202:
+        logger.info("Successfully applied run %s", run_id)
+        finish_run(run_id)
+    elif apply_response.status_code == 409:
+        logger.debug("Still waiting for %s to ask for plan confirmation.", run_id)
+        enqueue_run(run_id, attempt + 1)
+    else:
+        logger.warning("Unexpected status code %s for run %s", apply_response.status_code, run_id)
+        finish_run(run_id)
 
 
 def process_queue():
-    prev_run_id = None
     apply_payload = {
         "data": {
             "type": "runs",
@@ -49,190 +250,218 @@ def process_queue():
             }
         }
     }
+    apply_body = orjson.dumps(apply_payload)
 
     while True:
-        # Get the next run-id from the queue. If there's nothing in the queue,
-        # block until there is a run-id
-        run_id = run_ids_queue.get()
-        print(f"Processing {run_id} from queue.")
-
-        # If we just tried the previous run-id, go ahead and wait 5 seconds.
-        # This accounts for time when the plan could be performing cost estimation
-        # or some other longer task.
-        if prev_run_id == run_id:
-            print(f"Retrying the previous {run_id}. Sleeping for 5 seconds")
-            time.sleep(5)
-
-        # Since we can continue before reaching the end of this block, update the run id now.
-        prev_run_id = run_id
-
-        # Get the run details
-        run_details_url = f"https://app.terraform.io/api/v2/runs/{run_id}"
-        run_response = requests.get(run_details_url, headers=tfc_headers)
-        if run_response.status_code != 200:
-            # We errored here for some reason, remove this run id
-            print(f"Failed to get run details for {run_id} - {run_response.text}")
-            print(f"Removing {run_id} from the processing queue.")
-            continue
-
-        # Check the status of the run id to ensure it hasn't already planned and finished.
-        # This could happen if the plan produced no chances and an apply was not required.
-        run_response_json = run_response.json()
-        if run_response_json["data"]["attributes"]["status"] == "planned_and_finished":
-            print(f"{run_id} was planned and finished successfully. Removing from processing queue.")
+        # Wait until the earliest run in the queue is due. Retried runs back off to allow
+        # for time when the plan could be performing cost estimation or some other longer
+        # task. A newly queued run wakes us up straight away.
+        with pending_runs_cv:
+            while not pending_runs or pending_runs[0][0] > time.monotonic():
+                pending_runs_cv.wait(pending_runs[0][0] - time.monotonic() if pending_runs else None)
+
+            # Take every run that is due so they can be checked in one batch.
+            attempts = {}
+            while pending_runs and pending_runs[0][0] <= time.monotonic() and len(attempts) < 100:
+                _, run_id, attempt = heapq.heappop(pending_runs)
+                attempts[run_id] = max(attempt, attempts.get(run_id, 0))
+        run_ids = list(attempts)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Processing %s from queue.", ", ".join(run_ids))
+        try:
+            run_states = get_run_states(run_ids)
+        except httpx.HTTPError as e:
+            # TFC timed out or the connection failed. Try the batch again later rather
+            # than letting the exception stop the polling thread.
+            logger.warning("Failed to get run details for %s - %s", ", ".join(run_ids), e)
+            for run_id in run_ids:
+                enqueue_run(run_id, attempts[run_id] + 1)
             continue
-
-        # Before trying to apply the run, check to see if it's confirmable.
-        if run_response_json["data"]["attributes"]["actions"]["is-confirmable"] == False:
-            print(f"Still waiting for {run_id} to ask for plan confirmation.")
-            run_ids_queue.put(run_id)
+        except Exception:
+            # Most likely an unexpected payload from TFC. This is the only polling thread,
+            # so log it and retry the batch later rather than letting it die.
+            logger.exception("Failed to get run details for %s.", ", ".join(run_ids))
+            for run_id in run_ids:
+                enqueue_run(run_id, attempts[run_id] + 1)
             continue
 
-        # We're in a good state and the run should be able to be applied.
-        apply_url = f"https://app.terraform.io/api/v2/runs/{run_id}/actions/apply"
-        apply_response = requests.post(apply_url, headers=tfc_headers, json=apply_payload)
-        if apply_response.status_code == 202:
-            print(f"Successfully applied run {run_id}")
-        elif apply_response.status_code == 409:
-            print(f"Still waiting for {run_id} to ask for plan confirmation.")
-            run_ids_queue.put(run_id)
-        else:
-            print(f"Unexpected status code {apply_response.status_code} for run {run_id}")
+        for run_id in run_ids:
+            try:
+                apply_run(run_id, run_states.get(run_id), attempts[run_id], apply_body)
+            except Exception:
+                logger.exception("Failed to process run %s.", run_id)
+                enqueue_run(run_id, attempts[run_id] + 1)
 
 
-def process_request(body: Dict[str, Any], body_raw: str, request_hmac: str) -> Dict[str, Any]:
+def process_request(body: Dict[str, Any], body_raw: bytes, request_hmac: str) -> Dict[str, Any]:
+    # body is the parsed run task payload and body_raw the exact bytes TFC signed.
     run_task_headers = {
         "Authorization": f"Bearer {body['access_token']}",
         "Content-Type": "application/vnd.api+json"
     }
 
-    # Create a default body. Fail by default.
-    tfc_body = {
-        "data": {
-            "type": "task-results",
-            "attributes": {
-                "status": "failed"
-            }
-        }
-    }
-    tfc_body_attributes = tfc_body["data"]["attributes"]
-
     # Optional but recommended HMAC check
-    generated_hmac = hmac.new(secret_key, body_raw, hashlib.sha512)
-    if request_hmac != generated_hmac.hexdigest():
-        print("HMACs do not match.")
-        print(f"Request: {request_hmac}")
-        print(f"genearted: {generated_hmac.hexdigest()}")
-        tfc_body_attributes["message"] = "Invalid HMAC."
-        tfc_body_attributes["status"] = "failed"
-        patch_response = requests.patch(body.get("task_result_callback_url"),
-                                        json.dumps(tfc_body),
-                                        headers=run_task_headers)
+    if isinstance(body_raw, str):
+        body_raw = body_raw.encode("utf-8")
+    if hmac_algo == "blake2b":
+        generated_hmac = hashlib.blake2b(body_raw, key=secret_key, digest_size=32).hexdigest()
+    else:
+        generated = hmac.new(secret_key, None, hashlib.sha512)
+        generated.update(body_raw)
+        generated_hmac = generated.hexdigest()
+    if request_hmac is None or not hmac.compare_digest(request_hmac.encode(), generated_hmac.encode()):
+        logger.warning("HMACs do not match.")
+        logger.debug("Request: %s", request_hmac)
+        logger.debug("Generated: %s", generated_hmac)
+        message = "Invalid HMAC."
+        patch_response = http.patch(body.get("task_result_callback_url"),
+                                    content=_task_result_failed_tpl % orjson.dumps(message),
+                                    headers=run_task_headers,
+                                    timeout=tfc_timeout)
         return patch_response
 
     # Ensure that we're actually getting called for a run task
     if "task_result_callback_url" not in body:
         # There's nothing to call back to, so we'll just return.
-        print("task_result_callback_url not found in the request body.")
+        logger.warning("task_result_callback_url not found in the request body.")
         return
 
     # We only want this run task to handle the post_plan phase
     if body.get("stage") != "post_plan":
-        tfc_body_attributes["message"] = "Nothing to do. This is not a post_plan phase."
-        tfc_body_attributes["status"] = "passed"
-        patch_response = requests.patch(body.get("task_result_callback_url"),
-                                        json.dumps(tfc_body),
-                                        headers=run_task_headers)
+        message = "Nothing to do. This is not a post_plan phase."
+        patch_response = http.patch(body.get("task_result_callback_url"),
+                                    content=_task_result_passed_tpl % orjson.dumps(message),
+                                    headers=run_task_headers,
+                                    timeout=tfc_timeout)
         return patch_response
 
     run_id = body.get("run_id")
     if not run_id:
-        print("Run ID not found in the request body.")
-        tfc_body_attributes["message"] = "There was no run_id specified in the payload."
-        tfc_body_attributes["status"] = "failed"
-        patch_response = requests.patch(body.get("task_result_callback_url"),
-                                        json.dumps(tfc_body),
-                                        headers=run_task_headers)
+        logger.warning("Run ID not found in the request body.")
+        message = "There was no run_id specified in the payload."
+        patch_response = http.patch(body.get("task_result_callback_url"),
+                                    content=_task_result_failed_tpl % orjson.dumps(message),
+                                    headers=run_task_headers,
+                                    timeout=tfc_timeout)
         return patch_response
 
-    print(f"Processing message received from {run_id}")
+    logger.debug("Processing message received from %s", run_id)
+
+    # If we've seen this run before we already know its workspace, so look the workspace
+    # up in parallel with the run details rather than waiting on one after the other.
+    # There's no need when its auto-apply setting is already cached.
+    with _ws_lock:
+        workspace_id = _run_ws_cache.get(run_id)
+        cached_auto_apply = _ws_cache.get(workspace_id) if workspace_id else None
+    workspace_future = None
+    if workspace_id and cached_auto_apply is None:
+        workspace_future = lookup_pool.submit(get_workspace_auto_apply, workspace_id)
 
     # Get the run details from TFC
     run_details_url = f"https://app.terraform.io/api/v2/runs/{run_id}"
-    run_response = requests.get(run_details_url, headers=tfc_headers)
-    if run_response.status_code != 200:
+    try:
+        run_response = http.get(run_details_url, timeout=tfc_timeout)
+        run_error = run_response.text if run_response.status_code != 200 else None
+    except httpx.HTTPError as e:
+        run_error = str(e)
+    if run_error is not None:
         # We can't get the run details. We can't really continue.
-        tfc_body_attributes["message"] = f"Failed to get run details: {run_response.text}"
-        tfc_body_attributes["status"] = "failed"
-        patch_response = requests.patch(body.get("task_result_callback_url"),
-                                        json.dumps(tfc_body),
-                                        headers=run_task_headers)
+        logger.warning("Failed to get run details for %s - %s", run_id, run_error)
+        message = f"Failed to get run details: {run_error}"
+        patch_response = http.patch(body.get("task_result_callback_url"),
+                                    content=_task_result_failed_tpl % orjson.dumps(message),
+                                    headers=run_task_headers,
+                                    timeout=tfc_timeout)
         return patch_response
 
-    run_response_json = run_response.json()
+    run_data = orjson.loads(run_response.content)["data"]
     # See if the source of this run was a run trigger rather than from VCS or from the UI.
-    if run_response_json["data"]["attributes"]["source"] != "tfe-run-trigger":
-        print(f"Nothing to do. {run_id} is not type 'tfe-run-trigger'.")
-        tfc_body_attributes["message"] = "Nothing to do. This is not a run triggered run."
-        tfc_body_attributes["status"] = "passed"
-        patch_response = requests.patch(body.get("task_result_callback_url"),
-                                        json.dumps(tfc_body),
-                                        headers=run_task_headers)
+    if run_data["attributes"]["source"] != "tfe-run-trigger":
+        logger.info("Nothing to do. %s is not type 'tfe-run-trigger'.", run_id)
+        message = "Nothing to do. This is not a run triggered run."
+        patch_response = http.patch(body.get("task_result_callback_url"),
+                                    content=_task_result_passed_tpl % orjson.dumps(message),
+                                    headers=run_task_headers,
+                                    timeout=tfc_timeout)
         return patch_response
 
     # Optional, but check the workspace to see if the setting allows for auto-apply.
-    workspace_id = run_response_json["data"]["relationships"]["workspace"]["data"]["id"]
-    workspace_url = f"https://app.terraform.io/api/v2/workspaces/{workspace_id}"
-    workspace_response = requests.get(workspace_url, headers=tfc_headers)
-    if workspace_response.status_code != 200:
-        # We can't get the run details. We can't really continue.
-        tfc_body_attributes["message"] = f"Failed to get workspace details: {workspace_response.text}"
-        tfc_body_attributes["status"] = "failed"
-        patch_response = requests.patch(body.get("task_result_callback_url"),
-                                        json.dumps(tfc_body),
-                                        headers=run_task_headers)
+    if cached_auto_apply is not None:
+        auto_apply, workspace_error = cached_auto_apply, None
+    elif workspace_future is not None:
+        auto_apply, workspace_error = workspace_future.result()
+    else:
+        workspace_id = run_data["relationships"]["workspace"]["data"]["id"]
+        with _ws_lock:
+            _run_ws_cache[run_id] = workspace_id
+        auto_apply, workspace_error = get_workspace_auto_apply(workspace_id)
+    if workspace_error is not None:
+        # We can't get the workspace details. We can't really continue.
+        logger.warning("Failed to get workspace details for %s - %s", run_id, workspace_error)
+        message = f"Failed to get workspace details: {workspace_error}"
+        patch_response = http.patch(body.get("task_result_callback_url"),
+                                    content=_task_result_failed_tpl % orjson.dumps(message),
+                                    headers=run_task_headers,
+                                    timeout=tfc_timeout)
         return patch_response
 
-    workspace_response_json = workspace_response.json()
     # Only apply this run if auto-apply is set on the workspace.
-    if workspace_response_json["data"]["attributes"]["auto-apply"] == False:
-        print("The auto-apply attribute is not enabled for this workspace.")
-        tfc_body_attributes["message"] = "Nothing to do. Workspace is not configured for auto-apply"
-        tfc_body_attributes["status"] = "passed"
-        patch_response = requests.patch(body.get("task_result_callback_url"),
-                                        json.dumps(tfc_body),
-                                        headers=run_task_headers)
+    if auto_apply == False:
+        logger.info("The auto-apply attribute is not enabled for this workspace.")
+        message = "Nothing to do. Workspace is not configured for auto-apply"
+        patch_response = http.patch(body.get("task_result_callback_url"),
+                                    content=_task_result_passed_tpl % orjson.dumps(message),
+                                    headers=run_task_headers,
+                                    timeout=tfc_timeout)
         return patch_response
 
     # https://developer.hashicorp.com/terraform/cloud-docs/api-docs/run#apply-a-run
     # We can't call apply right away as the run isn't pasued for confirmation and the
     # apply endpoint will respond with a 409. Instead, add the run id to a threaded queue
     # that will attempt to apply the run with retry logic.
-    run_ids_queue.put(run_id)
-    tfc_body_attributes["message"] = f"Added {run_id} to the queue to be auto-applied when ready."
-    tfc_body_attributes["status"] = "passed"
-    patch_response = requests.patch(body.get("task_result_callback_url"),
-                                    json.dumps(tfc_body),
-                                    headers=run_task_headers)
+    enqueue_run(run_id)
+    message = f"Added {run_id} to the queue to be auto-applied when ready."
+    patch_response = http.patch(body.get("task_result_callback_url"),
+                                content=_task_result_passed_tpl % orjson.dumps(message),
+                                headers=run_task_headers,
+                                timeout=tfc_timeout)
     return patch_response
 
 
+def _log_request_error(future) -> None:
+    # The pool keeps a worker's exception on its future, so log it or it's lost.
+    error = future.exception()
+    if error is not None:
+        logger.error("Failed to process run task request.", exc_info=error)
+
+
 @app.route('/', methods=['POST'])
 def run_function():
-    req_data_json = request.get_json()
+    # Read the raw body once. It's needed as-is for the HMAC check and orjson parses it
+    # without going through Werkzeug's get_json.
+    body_raw = request.get_data(cache=False)
+    try:
+        req_data_json = orjson.loads(body_raw)
+    except orjson.JSONDecodeError:
+        logger.warning("Request body is not valid JSON.")
+        return Flask_Response(status=400)
+    if not isinstance(req_data_json, dict):
+        logger.warning("Request body is not a JSON object.")
+        return Flask_Response(status=400)
     # Debug output
-    if debug_statements:
-        print(json.dumps(req_data_json, indent=2))
-        print(str(request.headers))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(orjson.dumps(req_data_json, option=orjson.OPT_INDENT_2).decode())
+        logger.debug(str(request.headers))
 
     # When adding your run task to TFC, TFC makes a call and expects a 200 response.
     if req_data_json.get("task_result_enforcement_level") != "test":
-        # Not the initial test call. Start a thread and process the request
-        thread = Thread(target=process_request,
-                        args=(req_data_json,
-                              request.data,
-                              request.headers.get("X-Tfc-Task-Signature")))
-        thread.start()
+        # Not the initial test call. Hand the request off to the worker pool
+        future = request_pool.submit(process_request,
+                                     req_data_json,
+                                     body_raw,
+                                     request.headers.get("X-Tfc-Task-Signature"))
+        future.add_done_callback(_log_request_error)
 
     # TFC expects a 200 that we received the message
     # print(f"processing_thread: {processing_thread.is_alive()}")
@@ -246,8 +475,11 @@ def favicon():
 
 
 def start_processing_thread():
-    # Create the thread that will monitor the queue
+    # Create the thread that will monitor the queue. Only one per process, no matter
+    # how many times this gets called.
     global processing_thread
+    if processing_thread is not None:
+        return
     processing_thread = Thread(target=process_queue)
     processing_thread.daemon = True
     processing_thread.start()
@@ -256,7 +488,7 @@ def start_processing_thread():
 if __name__ == '__main__':
     start_processing_thread()
 
-    # Cloud Run start
-    app.run(debug=True, threaded=True, ssl_context='adhoc', host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
+    # Local development only. TLS is terminated upstream (Cloud Run or a load balancer)
+    # and production runs under gunicorn.
+    app.run(threaded=True, host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
 
-    # app.run(threaded=True, ssl_context='adhoc')